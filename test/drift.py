@@ -7,10 +7,11 @@ import pandas as pd
 fname = "20240714-134022_1000_battery.hdf5"
 srate = 1000
 
-df = pd.read_hdf(fname, "eeg")
-length = len(df)
-start = df.index[0]
-stop = df.index[-1]
+# Only read the first and last rows
+with pd.HDFStore(fname, "r") as store:
+    length = store.get_storer("eeg").nrows
+    start = store.select("eeg", start=0, stop=1).index[0]
+    stop = store.select("eeg", start=length - 1, stop=length).index[0]
 duration = (stop - start).total_seconds()
 rate = length / duration
 drift = ((srate * 3600) - (rate * 3600)) / srate
@@ -0,0 +1,197 @@
+"""Tests for the OctaEEG driver"""
+
+import pytest
+import numpy as np
+from timeflux_octaeeg.nodes import driver
+from timeflux_octaeeg.nodes.driver import OctaEEG, BLOCK, CHANNELS, decode
+
+RATE = 1000
+PERIOD = 1_000_000 // RATE
+START = 1_700_000_000_000_000
+
+
+class Clock:
+    """Host clock, in microseconds."""
+
+    def __init__(self):
+        self.time = START
+
+    def __call__(self):
+        return np.datetime64(int(self.time), "us")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(driver, "now", clock)
+    return clock
+
+
+@pytest.fixture
+def node():
+    node = OctaEEG.__new__(OctaEEG)
+    node.rate = RATE
+    node._reset_clock()
+    return node
+
+
+def ticks(start, count=100):
+    return np.arange(start, start + count * PERIOD, PERIOD) % (1 << 32)
+
+
+def test_wrap(node, clock):
+    start = (1 << 32) - 50 * PERIOD
+    clock.time = START
+    first = node._clock(ticks(start))
+    clock.time += 100 * PERIOD
+    second = node._clock(ticks(start + 100 * PERIOD))
+    output = np.concatenate((first, second))
+    assert node._wraps == 1
+    assert np.all(np.diff(output) == PERIOD)
+    assert output[-1] == clock.time
+
+
+def test_reset(node, clock):
+    node._clock(ticks(3_500_000_000))
+    clock.time += 100 * PERIOD
+    output = node._clock(ticks(0))
+    assert node._wraps == 0
+    assert output[-1] == clock.time
+    assert np.all(np.diff(output) == PERIOD)
+
+
+def test_reset_mid_batch(node, clock):
+    node._clock(ticks(1_000_000))
+    clock.time += 10 * PERIOD
+    batch = np.concatenate((ticks(1_000_000 + 100 * PERIOD, 5), ticks(0, 5)))
+    output = node._clock(batch)
+    assert np.all(np.diff(output) > 0)
+    assert output[-1] == clock.time
+
+
+def test_reset_mid_first_batch(node, clock):
+    batch = np.concatenate((ticks(1_000_000, 5), ticks(0, 5)))
+    output = node._clock(batch)
+    assert np.all(np.diff(output) == PERIOD)
+    assert output[-1] == clock.time
+
+
+def test_drift(node, clock):
+    drift = 1e-3
+    for batch in range(600):
+        device = ticks(batch * 100 * PERIOD)
+        clock.time = START + int(device[-1] * (1 + drift))
+        output = node._clock(device)
+    assert node.drift == pytest.approx(drift)
+    expected = START + np.rint(device * (1 + drift))
+    assert np.abs(output - expected).max() <= 1
+
+
+def test_reset_from_counter(node, clock):
+    start = (1 << 32) - 100 * PERIOD
+    node._clock(ticks(start))
+    clock.time += 100 * PERIOD
+    # The timing is consistent with an overflow, but the counter went back
+    output = node._clock(ticks(0), np.array([0]))
+    assert node._wraps == 0
+    assert output[-1] == clock.time
+
+
+def test_missing(node):
+    node._counter = None
+    node._missing = 0
+    node._duplicated = 0
+    assert len(node._check(np.array([1, 2, 5, 6], dtype=np.uint32))) == 0
+    assert node._missing == 2
+    restarts = node._check(np.array([(1 << 32) - 1, 0, 1], dtype=np.uint32))
+    assert list(restarts) == [0]
+    assert node._missing == 2
+
+
+def test_drift_with_latency(node, clock):
+    drift = 50e-6
+    latency = np.random.default_rng(42).exponential(15000, 2000)
+    outputs = []
+    for batch in range(2000):
+        device = ticks(batch * 100 * PERIOD)
+        clock.time = START + int(device[-1] * (1 + drift) + latency[batch])
+        outputs.append(node._clock(device))
+    output = np.concatenate(outputs)
+    assert np.all(np.diff(output) > 0)
+    assert node.drift == pytest.approx(drift, abs=5e-6)
+    expected = START + np.rint(device * (1 + drift))
+    assert np.abs(outputs[-1] - expected).max() < 2000
+
+
+def test_duplicated(node):
+    node._counter = None
+    node._missing = 0
+    node._duplicated = 0
+    assert len(node._check(np.array([1, 2, 2, 3], dtype=np.uint32))) == 0
+    assert node._missing == 0
+    assert node._duplicated == 1
+
+
+def test_decode():
+    values = np.array([0, 1, -1, 8388607, -8388608, 100, -100, 12345])
+    raw = (values & 0xFFFFFF).astype(">u4").view(np.uint8).reshape(-1, 4)[:, 1:]
+    samples = np.stack((raw, raw[::-1])).reshape(2, CHANNELS, 3)
+    out = np.zeros((4, CHANNELS), dtype=np.float32)
+    decode(samples, np.float32(0.5), out[1:3])
+    assert out.dtype == np.float32
+    assert np.array_equal(out[1], values * 0.5)
+    assert np.array_equal(out[2], values[::-1] * 0.5)
+    assert not out[0].any() and not out[3].any()
+
+
+def frame(counters):
+    data = np.zeros(len(counters), dtype=BLOCK)
+    data["header"][:, 0] = 1_000_000 + np.asarray(counters) * PERIOD
+    data["header"][:, 1] = counters
+    data["samples"][:, :, 2] = np.asarray(counters)[:, None] % 128
+    return data.tobytes()
+
+
+def test_ring(clock):
+    node = OctaEEG.__new__(OctaEEG)
+    node.rate = RATE
+    node.debug = True
+    node.names = ["TIMESTAMP", "COUNTER"] + list(range(1, CHANNELS + 1))
+    node.meta = {"rate": RATE}
+    node._scale = np.float32(1)
+    node._reset(8)
+    frames = []
+
+    def recv():
+        if frames:
+            return frames.pop(0)
+        node._running = False
+        return b""
+
+    node._recv = recv
+
+    def acquire(*counters):
+        frames.extend(frame(batch) for batch in counters)
+        node._running = True
+        node._loop()
+        node.update()
+        return node.o.data
+
+    # Fill part of the ring
+    data = acquire(range(0, 6))
+    assert (node._head, node._tail) == (6, 6)
+    assert list(data["COUNTER"]) == list(range(0, 6))
+    # Wrap around
+    data = acquire(range(6, 11))
+    assert (node._head, node._tail) == (11, 11)
+    assert list(data["COUNTER"]) == list(range(6, 11))
+    assert list(data[1]) == list(range(6, 11))
+    # Overflow, the newest samples are dropped
+    data = acquire(range(11, 16), range(16, 21))
+    assert (node._head, node._tail) == (19, 19)
+    assert list(data["COUNTER"]) == list(range(11, 19))
+    assert node.o.meta == {"rate": RATE, "dropped": 2, "missing": 0, "duplicated": 0}
+    assert list(data.columns) == node.names
+    assert list(data.dtypes) == [np.uint32] * 2 + [np.float32] * CHANNELS
+    assert data.index.dtype == "datetime64[us]"
+    assert data.index.is_monotonic_increasing
@@ -3,17 +3,61 @@
 import websocket
 import json
 import socket
+import select
 import numpy as np
+import pandas as pd
 from timeflux.core.node import Node
 from timeflux.core.exceptions import WorkerInterrupt
 from timeflux.helpers.clock import now
-from threading import Thread, Lock
+from threading import Thread
 
 
 # RATES = { 250: 0x96, 500: 0x95, 1000: 0x94, 2000: 0x93, 4000: 0x92, 8000: 0x91, 16000: 0x90 }
 RATES = { 250: 0x96, 500: 0x95, 1000: 0x94, 2000: 0x93, 4000: 0x92, 8000: 0x91 } # Limited to 8 kSPS for now
 GAINS = { 1: 0x00, 2: 0x10, 4:0x20, 6: 0x30, 8: 0x40, 12: 0x50, 24: 0x60 }
 CHANNELS = 8
+# Device timestamp and sample counter (little-endian), followed by 24-bit samples (big-endian)
+BLOCK = np.dtype([("header", "<u4", (2,)), ("samples", "u1", (CHANNELS, 3))])
+BUFFER = 10 # Cache size, in seconds
+DRIFT = 10 # Drift estimation period, in seconds
+JITTER = 1 # Tolerance when telling clock overflows from resets, in seconds
+SLEW = 0.001 # Maximum clock correction, relative to the device rate
+
+
+def command(name, *parameters):
+    """Serialize a device command."""
+    return json.dumps({"command": name, "parameters": list(parameters)})
+
+
+# Commands that do not depend on the node parameters
+SDATAC = command("sdatac")
+RDATAC = command("rdatac")
+STATUS = command("status")
+CONFIG = (command("wreg", 0x02, 0xC0), command("wreg", 0x03, 0xEC), command("wreg", 0x15, 0x20))
+
+# Register writes for each allowed rate and gain
+RATE_COMMANDS = {rate: command("wreg", 0x01, value) for rate, value in RATES.items()}
+GAIN_COMMANDS = {
+    gain: tuple(command("wreg", register, value) for register in range(0x05, 0x0D))
+    for gain, value in GAINS.items()
+}
+
+
+def decode(samples, scale, out):
+    """Convert raw samples to microvolts.
+
+    Args:
+        samples (ndarray): The 24-bit big-endian samples, of shape `(n, CHANNELS, 3)`.
+        scale (float32): The conversion factor from raw values to microvolts.
+        out (ndarray): The preallocated destination, of shape `(n, CHANNELS)`.
+    """
+    # Copy each sample into the most significant bytes of a big-endian 32-bit word,
+    # then shift it back in place: the arithmetic shift takes care of the sign
+    words = np.zeros(samples.shape[:-1] + (4,), dtype=np.uint8)
+    words[..., :3] = samples
+    values = words.view(">i4")[..., 0] >> 8
+    np.multiply(values, scale, out=out, dtype=np.float32)
+
 
 class OctaEEG(Node):
 
@@ -30,7 +74,9 @@ class OctaEEG(Node):
         debug (bool): If `True`, add the internal timestamp and counter. Default: `False`.
 
     Attributes:
-        o (Port): Default output, provides DataFrame.
+        o (Port): Default output, provides DataFrame of float32 samples, in microvolts.
+            The meta also holds the total number of `dropped` samples, and of
+            `missing` and `duplicated` packets according to the device counter.
 
     Example:
         .. literalinclude:: /../examples/test.yaml
@@ -50,6 +96,7 @@ class OctaEEG(Node):
             )
         self.rate = rate
         self.gain = gain
+        self._scale = np.float32(1e6 * ((4.5 / 8388607) / gain)) # raw value to uV
 
         # Debug mode
         self.debug = debug
@@ -63,7 +110,14 @@ class OctaEEG(Node):
             self.names = ["TIMESTAMP", "COUNTER"] + self.names
 
         # Connect
-        self._ws = websocket.WebSocket()
+        # Disable Nagle's algorithm and leave room in the kernel buffer for bursts
+        self._ws = websocket.WebSocket(
+            sockopt=[
+                (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20),
+            ],
+            skip_utf8_validation=True,
+        )
         try:
             self._ws.connect(f"ws://{socket.gethostbyname('oric.local')}:81")
             self.logger.debug("Connected")
@@ -72,92 +126,297 @@ class OctaEEG(Node):
 
         # Initialize the ADS1299
         # See: https://www.ti.com/lit/ds/symlink/ads1299.pdf
-        self._ws.send_text(json.dumps({"command":"sdatac", "parameters":[]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x01, RATES[rate]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x02, 0xC0]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x03, 0xEC]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x15, 0x20]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x05, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x06, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x07, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x08, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x09, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x0A, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x0B, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"wreg", "parameters":[0x0C, GAINS[gain]]}))
-        self._ws.send_text(json.dumps({"command":"status", "parameters":[]}))
-        self._ws.send_text(json.dumps({"command":"rdatac", "parameters":[]}))
+        self._ws.send_text(SDATAC)
+        self._set_rate(rate)
+        for message in CONFIG:
+            self._ws.send_text(message)
+        self._set_gain(gain)
+        self._ws.send_text(STATUS)
+        self._ws.send_text(RDATAC)
 
         # Set meta
         self.meta = { "rate": rate }
 
         # Launch background thread
-        self._reset()
-        self._lock = Lock()
+        self._reset(rate * BUFFER)
+        self._batch = (rate // 10) * BLOCK.itemsize # Do not wait for more than 100 ms of data
         self._running = True
-        self._thread = Thread(target=self._loop).start()
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+
+    def _set_rate(self, rate):
+        """Write the sampling rate register."""
+        self._ws.send_text(RATE_COMMANDS[rate])
+
+
+    def _set_gain(self, gain):
+        """Write the gain of each channel."""
+        for message in GAIN_COMMANDS[gain]:
+            self._ws.send_text(message)
+
+
+    def _reset(self, capacity):
+        """Allocate the ring buffer.
 
+        The acquisition thread is the only writer and only moves the head, while
+        :meth:`update` is the only reader and only moves the tail. Both indices
+        grow monotonically and each side publishes its own index last, so no lock
+        is required. When the consumer falls behind and the ring is full, incoming
+        samples are dropped and counted, so that memory and latency stay bounded.
+        """
+        self._capacity = capacity
+        self._samples = np.empty((capacity, CHANNELS), dtype=np.float32)
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._headers = np.empty((capacity, 2), dtype=np.uint32)
+        self._head = 0
+        self._tail = 0
+        self._dropped = 0
+        self._missing = 0
+        self._duplicated = 0
+        self._reported = {"dropped": 0, "missing": 0, "duplicated": 0}
 
-    def _reset(self):
-        """Empty cache."""
-        self._rows = []
-        self._timestamps = []
+
+    def _slices(self, start, stop):
+        """Map a range of indices to at most two contiguous regions of the ring."""
+        begin = start % self._capacity
+        end = begin + stop - start
+        if end <= self._capacity:
+            return [slice(begin, end)]
+        return [slice(begin, self._capacity), slice(0, end - self._capacity)]
 
 
     def _loop(self):
         """Acquire and cache data."""
-        self.delta = None
-        self.last = 0
+        self._reset_clock()
+        self._counter = None
+        read = self._read
+        slices = self._slices
+        capacity = self._capacity
+        cached_timestamps = self._timestamps
+        cached_samples = self._samples
+        cached_headers = self._headers
         while self._running:
-            timestamps, data = self._read()
-            if data:
-                self._lock.acquire()
-                self._rows += data
-                self._timestamps += timestamps
-                self._lock.release()
+            try:
+                timestamps, samples, headers = read()
+            except (websocket.WebSocketException, OSError):
+                if not self._running:
+                    break # The socket was shut down by terminate()
+                raise
+            if samples is not None:
+                head = self._head
+                size = len(samples)
+                count = min(size, capacity - (head - self._tail))
+                if count < size:
+                    self._dropped += size - count
+                offset = 0
+                for region in slices(head, head + count):
+                    end = offset + region.stop - region.start
+                    decode(samples[offset:end], self._scale, cached_samples[region])
+                    cached_timestamps[region] = timestamps[offset:end]
+                    cached_headers[region] = headers[offset:end]
+                    offset = end
+                self._head = head + count
+
+
+    def _recv(self):
+        """Drain the frames that are already available on the socket."""
+        frames = []
+        size = 0
+        batch = self._batch
+        recv = self._ws.recv_data
+        sock = [self._ws.sock]
+        binary = websocket.ABNF.OPCODE_BINARY
+        opcode, data = recv()
+        while True:
+            if data and opcode == binary:
+                frames.append(data)
+                size += len(data)
+            if size >= batch or not select.select(sock, [], [], 0)[0]:
+                break
+            opcode, data = recv()
+        return b"".join(frames)
 
 
     def _read(self):
         """Receive packets from the device."""
-        data = self._ws.recv()
-        block_size = 32
-        timestamps = []
-        rows = []
-        if data and (type(data) is list or type(data) is bytes):
-            # TODO: check impedance
-            # TODO: check for missing or out of order packets
-            for block_index in range(0, len(data), block_size):
-                block = data[block_index:block_index + block_size]
-                timestamp = int.from_bytes(block[0:4], byteorder="little")
-                counter = int.from_bytes(block[4:8], byteorder="little")
-                row = [timestamp, counter] if self.debug else []
-                if self.delta == None or self.last >= timestamp:
-                    # Make sure that the signal is not drifting and that we handle timestamp overflow properly
-                    self.delta = now() - np.datetime64(timestamp, "us")
-                self.last = timestamp
-                for channel in range(0, CHANNELS):
-                    channel_offset = 8 + (channel * 3)
-                    sample = int.from_bytes(block[channel_offset:channel_offset + 3], byteorder="big", signed=True)
-                    sample *= (1e6 * ((4.5 / 8388607) / self.gain)) # raw value to uV
-                    row.append(sample)
-                rows.append(row)
-                timestamps.append(np.datetime64(timestamp, "us") + self.delta)
-        return timestamps, rows
+        data = self._recv()
+        if not data:
+            return None, None, None
+        # TODO: check impedance
+        blocks = np.frombuffer(data, dtype=BLOCK, count=len(data) // BLOCK.itemsize)
+        if len(blocks) == 0:
+            return None, None, None
+        headers = blocks["header"]
+        restarts = self._check(headers[:, 1])
+        timestamps = self._clock(headers[:, 0], restarts)
+        return timestamps, blocks["samples"], headers
+
+
+    def _check(self, counters):
+        """Check for missing or out of order packets.
+
+        Returns:
+            ndarray: The indices where the counter went backwards.
+        """
+        counters = counters.astype(np.int64)
+        previous = counters[0] - 1 if self._counter is None else self._counter
+        steps = np.diff(counters, prepend=previous) % (1 << 32)
+        backwards = steps >= (1 << 31)
+        self._missing += int(np.sum(steps[(steps > 1) & ~backwards] - 1))
+        self._duplicated += int(np.count_nonzero(steps == 0))
+        self._counter = int(counters[-1])
+        return np.flatnonzero(backwards)
+
+
+    def _reset_clock(self):
+        """Forget the clock model."""
+        self.drift = 0.0
+        self.last = 0
+        self._wraps = 0
+        self._base = None
+        self._rate = 1.0
+        self._reference = None
+        self._best = None
+        self._calibration = None
+        self._received = None
+        self._previous = None
+
+
+    def _clock(self, timestamps, restarts=None):
+        """Convert device timestamps to host timestamps, in microseconds.
+
+        The device clock is anchored to the host clock once, matching the most recent
+        block with the reception time, and then extrapolated instead of being reset on
+        every overflow. Reception times are delayed by a variable network latency, so
+        only the earliest reception of each `DRIFT` seconds window, relative to the
+        current model, is kept. The drift is estimated between these points over the
+        whole acquisition, and the remaining offset is corrected by slewing the clock
+        by at most `SLEW` from its current position, never by a step. Timestamps are
+        therefore continuous and strictly increasing.
+
+        A backwards step of the device clock is only considered an overflow if the
+        device time it implies is consistent with the host time elapsed since the
+        previous batch, and if the device counter did not go backwards at the same
+        block (`restarts`). Otherwise, the device was reset and the clock is anchored
+        again. Blocks that precede a reset in the same batch are placed just before
+        the new segment.
+        """
+        host = now().astype("datetime64[us]").astype(np.int64)
+        ticks = timestamps.astype(np.int64)
+        # Tell overflows from resets
+        steps = np.diff(ticks, prepend=self.last)
+        backwards = np.flatnonzero(steps <= 0)
+        tolerance = JITTER * 1e6
+        if self._received is not None:
+            tolerance += host - self._received
+        wraps = np.zeros(len(ticks), dtype=bool)
+        wraps[backwards] = steps[backwards] + (1 << 32) <= tolerance
+        resets = backwards[~wraps[backwards]]
+        if restarts is not None and len(restarts):
+            wraps[restarts] = False
+            resets = np.union1d(backwards[~wraps[backwards]], restarts)
+        if self._base is None:
+            resets = np.union1d([0], resets)
+        # Unwrap the 32-bit device clock
+        ticks += (self._wraps + np.cumsum(wraps)) << 32
+        self._wraps += int(np.count_nonzero(wraps))
+        self.last = int(timestamps[-1])
+        self._received = host
+        # Start over if the device clock was reset
+        base, rate = self._base, self._rate
+        if len(resets):
+            self.drift = 0.0
+            self._base = (host, int(ticks[-1]))
+            self._rate = 1.0
+            self._reference = None
+            self._best = None
+            self._calibration = host
+        bounds = np.union1d([0, len(ticks)], resets)
+        output = np.empty_like(ticks)
+        start = bounds[-2]
+        output[start:] = self._extrapolate(ticks[start:], self._base, self._rate)
+        # Place the previous segments, if any
+        period = 1_000_000 // self.rate
+        for start, end in zip(bounds[-3::-1], bounds[-2:0:-1]):
+            before = output[end] - period
+            if start == 0 and base is not None:
+                values = self._extrapolate(ticks[start:end], base, rate)
+                values -= max(0, values[-1] - before)
+            else:
+                values = self._extrapolate(ticks[start:end], (before, ticks[end - 1]), rate)
+            output[start:end] = values
+        # Never go back in time, even after a reset
+        if self._previous is not None and output[0] <= self._previous:
+            shift = self._previous + period - output[0]
+            output += shift
+            self._base = (self._base[0] + shift, self._base[1])
+        self._previous = int(output[-1])
+        # Keep the reception with the lowest latency
+        residual = host - output[-1]
+        if self._best is None or residual < self._best[0]:
+            self._best = (residual, host, int(ticks[-1]))
+        # Refine the model
+        if host - self._calibration >= DRIFT * 1e6:
+            _, best_host, best_tick = self._best
+            if self._reference is not None:
+                baseline = best_tick - self._reference[1]
+                if baseline > 0:
+                    self.drift = (best_host - self._reference[0]) / baseline - 1
+            else:
+                self._reference = (best_host, best_tick)
+            # Slew towards the estimated host time, starting from the current position
+            target = best_host + (ticks[-1] - best_tick) * (1 + self.drift)
+            correction = np.clip((target - output[-1]) / (DRIFT * 1e6), -SLEW, SLEW)
+            self._base = (int(output[-1]), int(ticks[-1]))
+            self._rate = 1 + self.drift + correction
+            self._best = None
+            self._calibration = host
+        return output
+
+
+    def _extrapolate(self, ticks, base, rate):
+        """Map unwrapped device ticks to host microseconds."""
+        return base[0] + np.rint((ticks - base[1]) * rate).astype(np.int64)
 
 
     def update(self):
         """Update the node output."""
-        self._lock.acquire()
-        if self._rows:
-            self.o.set(self._rows, self._timestamps, self.names, meta=self.meta)
-            self._reset()
-        self._lock.release()
+        head = self._head
+        if head > self._tail:
+            regions = self._slices(self._tail, head)
+            rows = np.concatenate([self._samples[region] for region in regions])
+            timestamps = np.concatenate([self._timestamps[region] for region in regions])
+            index = pd.DatetimeIndex(timestamps.view("datetime64[us]"))
+            data = pd.DataFrame(rows, index=index, columns=self.names[-CHANNELS:], copy=False)
+            if self.debug:
+                headers = np.concatenate([self._headers[region] for region in regions])
+                data.insert(0, self.names[1], headers[:, 1])
+                data.insert(0, self.names[0], headers[:, 0])
+            self._tail = head
+            self.o.data = data
+            counts = {"dropped": self._dropped, "missing": self._missing, "duplicated": self._duplicated}
+            if counts["dropped"] > self._reported["dropped"]:
+                self.logger.warning("Buffer full, dropped %d samples", counts["dropped"] - self._reported["dropped"])
+            if counts["missing"] > self._reported["missing"]:
+                self.logger.warning("Missing %d packets", counts["missing"] - self._reported["missing"])
+            if counts["duplicated"] > self._reported["duplicated"]:
+                self.logger.warning("Duplicated %d packets", counts["duplicated"] - self._reported["duplicated"])
+            self._reported = counts
+            self.o.meta = {**self.meta, **counts}
 
 
     def terminate(self):
         """Cleanup."""
         self._running = False
-        while self._thread and self._thread.is_alive():
-            sleep(0.001)
+        self._thread.join(timeout=1.0)
+        if self._thread.is_alive():
+            # Still blocked in recv(), make it return
+            try:
+                self._ws.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._thread.join(timeout=1.0)
+        self._ws.close()
 
 